@@ -2,19 +2,35 @@
 
 import sys
 import os
+import errno
 import json
+import math
 import fnmatch
 import hashlib
 import tempfile
 import time
 import shutil
+import zlib
+import threading
 import requests
-import pathlib
 
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime, timedelta
-from io import BytesIO
 from zipfile import ZipFile
 from urllib.request import urlopen
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 here = os.path.abspath(os.path.dirname(__file__))
 
@@ -74,36 +90,165 @@ def set_env(name, value):
         environment_file.write("%s=%s" % (name, value))
 
 
-def get_file_hash(filepath, algorithm="sha256"):
-    """return an md5 hash of the file based on a criteria level. This
-    is intended to give the file a reasonable version.
+# We only compare content, so a cryptographic hash isn't needed by default
+DEFAULT_HASH = "xxh3_64" if xxhash else "blake2b"
 
-    Parameters
-    ==========
-    image_path: full path to the singularity image
+
+class Crc32:
     """
+    A hashlib-like wrapper for zlib.crc32, to compare files to zip members
+    """
+
+    def __init__(self):
+        self.crc = 0
+
+    def update(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+
+    def hexdigest(self):
+        return "%08x" % self.crc
+
+
+def get_hasher(algorithm):
+    """
+    Return a new hasher for an algorithm name. xxh3_64 requires xxhash.
+
+    Parameters:
+    algorithm (str) : xxh3_64, blake2b, crc32, or any other hashlib algorithm
+    """
+    if algorithm == "xxh3_64" and xxhash:
+        return xxhash.xxh3_64()
+    if algorithm == "crc32":
+        return Crc32()
+    if algorithm == "blake2b":
+        return hashlib.blake2b(digest_size=16)
     try:
-        hasher = getattr(hashlib, algorithm)()
+        return getattr(hashlib, algorithm)()
     except AttributeError:
         sys.exit("%s is an invalid algorithm." % algorithm)
 
-    with open(filepath, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hasher.update(chunk)
+
+def get_file_hash(filepath, algorithm=DEFAULT_HASH):
+    """return a hash of the file, intended to tell if content is the same.
+    Pass algorithm="sha256" when a cryptographic hash is needed.
+
+    Parameters
+    ==========
+    filepath: full path to the file to hash
+    algorithm: name of the algorithm (see get_hasher)
+    """
+    hasher = get_hasher(algorithm)
+
+    # Both paths read into their own buffer, so skip Python's buffering
+    with open(filepath, "rb", buffering=0) as f:
+        # Python 3.11+ runs the read/update loop in C with a reusable buffer
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(f, lambda: hasher).hexdigest()
+
+        buf = memoryview(bytearray(1 << 20))
+        while True:
+            size = f.readinto(buf)
+            if not size:
+                break
+            hasher.update(buf[:size])
     return hasher.hexdigest()
 
 
-def get_creation_timestamp(filename):
-    """Get creation timestamp for a file"""
-    filen = pathlib.Path(filename)
-    assert filen.exists()
-    return filen.stat().st_ctime
+def get_stat(filename):
+    """Get os.stat for a file (size, timestamps), or None if it doesn't exist"""
+    try:
+        return os.stat(filename)
+    except FileNotFoundError:
+        return None
 
 
-def get_size(filename):
-    filen = pathlib.Path(filename)
-    assert filen.exists()
-    return filen.stat().st_size
+def read_json(filename):
+    """
+    Read json from a file, returning None if it's missing or doesn't parse
+    (e.g., a previous run was killed while writing it).
+    """
+    try:
+        with open(filename, "r") as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return None
+
+
+def write_json(data, filename):
+    """
+    Write json to a temporary file alongside filename and move it into place,
+    so a run that is killed doesn't leave a partial file behind.
+    """
+    partial = filename + ".tmp"
+    with open(partial, "w") as fd:
+        json.dump(data, fd)
+    os.replace(partial, filename)
+
+
+# Digests by algorithm and path, reused while the file size, mtime and inode are
+# unchanged (a file moved into place with os.replace can keep the size and mtime)
+_hash_cache = {}
+
+
+def get_hash_cache_path(output):
+    return os.path.join(output, ".hashcache.json")
+
+
+def load_hash_cache(output):
+    """
+    Load digests saved by a previous run, if there are any. Anything we can't
+    read (or in an older format) is ignored, and the files are hashed again.
+    """
+    cache = read_json(get_hash_cache_path(output))
+    if not isinstance(cache, dict):
+        return
+    for algorithm, digests in cache.items():
+        if not isinstance(digests, dict):
+            continue
+        _hash_cache[algorithm] = {
+            path: tuple(entry)
+            for path, entry in digests.items()
+            if isinstance(entry, list) and len(entry) == 4
+        }
+
+
+def save_hash_cache(output):
+    """Save digests for files that still exist (temporary files are gone)"""
+    cache = {
+        algorithm: {
+            path: entry for path, entry in digests.items() if os.path.exists(path)
+        }
+        for algorithm, digests in _hash_cache.items()
+    }
+    write_json(cache, get_hash_cache_path(output))
+
+
+def cached_hash(filepath, algorithm=DEFAULT_HASH, st=None):
+    """Return the hash of a file, only reading it if it changed since last time.
+    Pass st if the file was already stat'd.
+    """
+    st = st or os.stat(filepath)
+    digests = _hash_cache.setdefault(algorithm, {})
+    entry = digests.get(filepath)
+    if entry and entry[:3] == (st.st_size, st.st_mtime_ns, st.st_ino):
+        return entry[3]
+    digest = get_file_hash(filepath, algorithm)
+    digests[filepath] = (st.st_size, st.st_mtime_ns, st.st_ino, digest)
+    return digest
+
+
+# Artifacts are downloaded in parallel, so writes to a result file are locked
+_path_locks = defaultdict(threading.Lock)
+_path_locks_lock = threading.Lock()
+
+# When the artifact each result file was saved from (this run) was created
+_saved_from = {}
+
+
+def get_path_lock(path):
+    """Get the lock for a result file path"""
+    with _path_locks_lock:
+        return _path_locks[path]
 
 
 ################################################################################
@@ -113,95 +258,321 @@ def get_size(filename):
 API_VERSION = "v3"
 BASE = "https://api.github.com"
 
-HEADERS = {
-    "Authorization": "token %s" % get_envar("GITHUB_TOKEN"),
-    "Accept": "application/vnd.github.%s+json;application/vnd.github.antiope-preview+json;application/vnd.github.shadow-cat-preview+json"
-    % API_VERSION,
-}
+# Artifacts per page (the maximum the API allows)
+PER_PAGE = 100
 
-# used to calculate if something is too old to parse
-today = datetime.now()
+# Longest time to sleep (seconds) before retrying a rate limited request
+MAX_BACKOFF = 600
 
 
-# URLs
-REPO_URL = "%s/repos/%s" % (BASE, get_envar("INPUT_REPOSITORY"))
-ARTIFACTS_URL = "%s/actions/artifacts" % REPO_URL
+def is_rate_limited(response):
+    """
+    Determine if a 403 or 429 response is a rate limit, from its headers
+    """
+    return (
+        response.status_code == 429
+        or "Retry-After" in response.headers
+        or response.headers.get("X-RateLimit-Remaining") == "0"
+    )
 
 
-def get_artifacts(repository, days=10):
+def get_retry_wait(response, attempt):
     """
-    Retrieve artifacts for a repository.
+    Return how long to sleep before retrying a rate limited response. Use the
+    wait GitHub asks for if there is one, otherwise back off exponentially.
+
+    Parameters:
+    response (requests.Response) : the 403 or 429 response
+    attempt                (int) : the number of retries so far
     """
-    # Check if the branch already has a pull request open
+    retry_after = response.headers.get("Retry-After", "")
+    reset = response.headers.get("X-RateLimit-Reset", "")
+    if retry_after.isdigit():
+        wait = int(retry_after)
+    elif response.headers.get("X-RateLimit-Remaining") == "0" and reset.isdigit():
+        wait = max(0, int(reset) - time.time()) + 1
+    else:
+        wait = 10 * 2**attempt
+    return min(wait, MAX_BACKOFF)
 
-    results = []
-    page = 1
 
-    while True:
-        params = {"per_page": 100, "page": page}
-        response = requests.get(ARTIFACTS_URL, params=params, headers=HEADERS)
-        print("Retrieving page %s for %s" % (page, ARTIFACTS_URL))
-        while response.status_code == 403:
-            print("API rate limit likely exceeded, sleeping for 10 minutes.")
-            time.sleep(600)
-            response = requests.get(ARTIFACTS_URL, params=params, headers=HEADERS)
-        if response.status_code != 200:
-            abort_if_fail(response, "Unable to retrieve artifacts")
-        response = response.json()
+def get_session(token):
+    """
+    Create a session for the GitHub API, shared by worker threads so that
+    connections are reused. Server errors are retried with backoff (rate
+    limits are left to get_with_backoff).
 
-        # We must break if found results > days old, otherwise we will continue
-        # and use up our API key!
-        artifacts = response["artifacts"]
-        if any([older_than(x, days) for x in artifacts]):
-            print("Results are older than %s days, stopping query." % days)
-            # but still add the last set since we have them
-            results += artifacts
-            break
+    Parameters:
+    token (str) : the GitHub token
+    """
+    session = requests.Session()
+    session.headers.update(
+        {
+            "Authorization": "token %s" % token,
+            "Accept": "application/vnd.github.%s+json;application/vnd.github.antiope-preview+json;application/vnd.github.shadow-cat-preview+json"
+            % API_VERSION,
+        }
+    )
+    retry = Retry(
+        total=5,
+        backoff_factor=1,
+        status_forcelist=[500, 502, 503, 504],
+        # Otherwise urllib3 also retries (and sleeps on) any 429 with Retry-After
+        respect_retry_after_header=False,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=retry)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_with_backoff(session, url, **kwargs):
+    """
+    Make a GET request with the session, sleeping and retrying while
+    the API rate limit is exceeded. Any other 403 (e.g. missing scopes)
+    is returned right away.
+    """
+    response = session.get(url, **kwargs)
+    attempt = 0
+    while response.status_code in [403, 429] and is_rate_limited(response):
+        wait = get_retry_wait(response, attempt)
+        print("API rate limit likely exceeded, sleeping for %d seconds." % wait)
+        time.sleep(wait)
+        response = session.get(url, **kwargs)
+        attempt += 1
+    return response
+
+
+# ETags and content of artifact pages by page url, for conditional requests
+_etags = {}
+_artifact_pages = {}
+
+
+def get_page_cache_paths(output):
+    return (
+        os.path.join(output, ".etags.json"),
+        os.path.join(output, ".artifacts_cache.json"),
+    )
+
+
+def load_page_cache(output):
+    """
+    Load ETags and artifact pages saved by a previous run, if there are any.
+    A cache we can't read is ignored, and its pages are retrieved again.
+    """
+    etags_file, pages_file = get_page_cache_paths(output)
+    etags = read_json(etags_file)
+    if isinstance(etags, dict):
+        _etags.update(
+            (key, etag) for key, etag in etags.items() if isinstance(etag, str)
+        )
+    pages = read_json(pages_file)
+    if isinstance(pages, dict):
+        _artifact_pages.update(
+            (key, page)
+            for key, page in pages.items()
+            if isinstance(page, dict) and "artifacts" in page
+        )
+
+
+def save_page_cache(output):
+    """
+    Save ETags and artifact pages for the next run. The ETags are removed
+    until the pages are saved, so if we are stopped in between, an ETag is
+    never used with a page it didn't come with.
+    """
+    os.makedirs(output, exist_ok=True)
+    etags_file, pages_file = get_page_cache_paths(output)
+    try:
+        os.remove(etags_file)
+    except FileNotFoundError:
+        pass
+    write_json(_artifact_pages, pages_file)
+    write_json(_etags, etags_file)
 
-        results += artifacts
-        # We are on the last page
-        count = len(response['artifacts'])
-        if count == 0:
-            break
-        page += 1
+
+def get_artifacts_page(session, url, page):
+    """
+    Retrieve one page of artifacts from the artifacts url of a repository.
+    If we have the page from before, only get it again if it changed.
+    """
+    params = {"per_page": PER_PAGE, "page": page}
+    key = "%s?per_page=%s&page=%s" % (url, PER_PAGE, page)
+    headers = {}
+    if key in _etags and key in _artifact_pages:
+        headers["If-None-Match"] = _etags[key]
+
+    response = get_with_backoff(session, url, params=params, headers=headers)
+    print("Retrieving page %s for %s" % (page, url))
+
+    # Not modified responses don't count against the rate limit
+    if response.status_code == 304:
+        return _artifact_pages[key]
+    if response.status_code != 200:
+        abort_if_fail(response, "Unable to retrieve artifacts")
+
+    # orjson parses pages much faster than json, if it's installed
+    if orjson:
+        result = orjson.loads(response.content)
+    else:
+        result = response.json()
+
+    if "ETag" in response.headers:
+        _etags[key] = response.headers["ETag"]
+        _artifact_pages[key] = result
+    return result
+
+
+def get_artifacts(session, repository, cutoff, workers=4):
+    """
+    Retrieve artifacts for a repository, until some are older than cutoff.
+    The first page gives the total count, and the rest are retrieved a few
+    pages at a time.
+    """
+    url = "%s/repos/%s/actions/artifacts" % (BASE, repository)
+    response = get_artifacts_page(session, url, 1)
+    pages = math.ceil(response["total_count"] / PER_PAGE)
+    artifacts = response["artifacts"]
+    results = list(artifacts)
+    page = 2
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+
+            # We must break if found results > days old, otherwise we will continue
+            # and use up our API key! (but we still keep the last set)
+            if any([older_than(x, cutoff) for x in artifacts]):
+                print("Results are older than %s, stopping query." % cutoff)
+                break
+
+            # We are on the last page
+            if page > pages:
+                break
+
+            batch = range(page, min(page + workers, pages + 1))
+            artifacts = [
+                x
+                for response in executor.map(
+                    lambda page: get_artifacts_page(session, url, page), batch
+                )
+                for x in response["artifacts"]
+            ]
+            results += artifacts
+            page += workers
 
     return results
 
 
-def older_than(artifact, days=2):
+def get_cutoff(today, days=2):
     """
-    Determine if an artifact is older than days, return True/False
+    Return the timestamp for days before today, in the same format as created_at
     """
-    start_date = today - timedelta(days=days)
-    created_at = artifact["created_at"]
-    created_timestamp = datetime.strptime(created_at, "%Y-%m-%dT%H:%M:%SZ")
-    diff = created_timestamp - start_date
-    # If the difference in days is negative, it was created before the start date
-    if diff.days < 0:
-        return True
-    return False
+    return (today - timedelta(days=days)).strftime("%Y-%m-%dT%H:%M:%SZ")
 
 
-def recursive_find(base, pattern="*"):
-    for root, _, filenames in os.walk(base):
-        for filename in fnmatch.filter(filenames, pattern):
-            yield os.path.join(root, filename)
+def older_than(artifact, cutoff):
+    """
+    Determine if an artifact was created before a cutoff from get_cutoff.
+    The timestamps have the same fixed width format, so compare as strings.
+    """
+    return artifact["created_at"] < cutoff
+
+
+def get_changed_members(zipfile, save_to, created_at):
+    """
+    Return the archive members to extract, skipping directories, empty files,
+    and files already saved with the same content (checked with the CRC32
+    stored in the archive, so the member isn't read). For those, remember
+    if this artifact (created at created_at) is the newest to have them.
+    """
+    members = []
+    for zi in zipfile.infolist():
+        if zi.is_dir():
+            continue
+
+        # If the file doesn't have size, don't add
+        if zi.file_size == 0:
+            print("Result file %s has size 0, skipping." % zi.filename)
+            continue
+
+        # Skip names that could point outside of save_to (extract would
+        # strip the parts, so it wouldn't be the file we compare with)
+        if zi.filename.startswith("/") or ".." in zi.filename.split("/"):
+            print("Result file %s has an unsafe path, skipping." % zi.filename)
+            continue
+
+        finalpath = os.path.join(save_to, os.path.normpath(zi.filename))
+        with get_path_lock(finalpath):
+            st = get_stat(finalpath)
+            if (
+                st
+                and st.st_size == zi.file_size
+                and cached_hash(finalpath, "crc32", st) == "%08x" % zi.CRC
+            ):
+                if created_at > _saved_from.get(finalpath, ""):
+                    _saved_from[finalpath] = created_at
+                continue
+        members.append(zi)
+    return members
+
+
+def extract_members(zipfile, members, path, executor):
+    """
+    Extract archive members to path using an executor (shared by all the
+    archives being extracted). zlib releases the GIL while decompressing, and
+    ZipFile locks the archive file for each read, so members can be
+    decompressed at the same time. Returns the extracted path for each member.
+    """
+    if len(members) < 2:
+        return [zipfile.extract(zi, path) for zi in members]
+
+    # If one fails, wait for the rest so nothing writes to path after we return
+    futures = [executor.submit(extract_member, zipfile, zi, path) for zi in members]
+    wait(futures)
+    return [future.result() for future in futures]
+
+
+def extract_member(zipfile, zi, path):
+    """
+    Extract one archive member to path. ZipFile.extract makes the parent
+    directories, and fails if another worker made the same one first, in
+    which case it now exists and we can try again.
+    """
+    try:
+        return zipfile.extract(zi, path)
+    except FileExistsError:
+        return zipfile.extract(zi, path)
 
 
-def download_artifacts(artifacts, output, days):
+def recursive_find(base, pattern="*"):
     """
-    Extract artifacts to an output directory
+    Yield an os.DirEntry for each file under base that matches a pattern
     """
-    if not os.path.exists(output):
-        os.makedirs(output)
+    stack = [base]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif pattern == "*" or fnmatch.fnmatch(entry.name, pattern):
+                    yield entry
 
-    # Make cache output and results output
-    for subpath in ["results"]:
-        path = os.path.join(output, subpath)
-        if not os.path.exists(path):
-            os.makedirs(path)
 
+def download_artifacts(session, artifacts, output, cutoff=None, workers=8):
+    """
+    Extract artifacts to an output directory, several artifacts at a time.
+    If a cutoff is given, skip artifacts created before it.
+    """
+    # Results are saved here (we don't save cache artifacts)
+    results_dir = os.path.join(output, "results")
+    os.makedirs(results_dir, exist_ok=True)
+    _saved_from.clear()
+
+    selected = []
     for artifact in artifacts:
+        if artifact["name"].startswith("cache"):
+            continue
+
         if artifact["expired"]:
             print(
                 "Artifact %s from %s is expired."
@@ -210,89 +581,237 @@ def download_artifacts(artifacts, output, days):
             continue
 
         # Is it within our number of days to check (a few might sneak through)
-        if days:
-            if older_than(artifact, days):
+        if cutoff:
+            if older_than(artifact, cutoff):
                 print(
-                    "Artifact %s was created %s, more than %s days ago."
-                    % (artifact["name"], artifact["created_at"], days)
+                    "Artifact %s was created %s, before %s."
+                    % (artifact["name"], artifact["created_at"], cutoff)
                 )
                 continue
+        selected.append(artifact)
+
+    # Downloading and extracting are separate stages, so downloads continue
+    # while archives are extracted. At most 2 * workers archives are waiting
+    # (downloading or downloaded) to be extracted. The members of all archives
+    # being extracted share one pool, bounded by the number of CPUs.
+    pending = threading.BoundedSemaphore(2 * workers)
+    stop = threading.Event()
+    downloads = ThreadPoolExecutor(max_workers=workers)
+    extractions = ThreadPoolExecutor(max_workers=workers)
+    member_extractions = ThreadPoolExecutor(max_workers=os.cpu_count())
+    executors = [downloads, extractions, member_extractions]
+    try:
+        futures = [
+            downloads.submit(
+                download_and_extract_artifact,
+                session,
+                artifact,
+                results_dir,
+                extractions,
+                member_extractions,
+                pending,
+                stop,
+            )
+            for artifact in selected
+        ]
+
+        # Raise any error (or exit) from a download or extraction here, as
+        # soon as it happens. A finished download gives its extraction.
+        running = set(futures)
+        while running:
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                extracted = future.result()
+                if extracted:
+                    running.add(extracted)
+
+    # Stop at the first error, without starting (or waiting for) the rest
+    except BaseException:
+        stop.set()
+        for executor in executors:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        # Extractions that already started save nothing more, so they finish
+        # quickly. Downloads would only be thrown away, so don't wait for them.
+        extractions.shutdown()
+        raise
+
+    for executor in executors:
+        executor.shutdown()
+
+
+def download_and_extract_artifact(
+    session, artifact, save_to, extractions, member_extractions, pending, stop
+):
+    """
+    Wait for a slot from pending, download an artifact, and submit it to the
+    extractions executor (which extracts its members with member_extractions).
+    The slot is released once it has been extracted.
+    Return the extraction future, or None if the download failed or we were
+    told to stop. We are told to stop if any extraction fails.
+    """
+    pending.acquire()
+    buf = None
+    try:
+        if not stop.is_set():
+            buf = download_artifact(session, artifact)
+    finally:
+        if buf is None:
+            pending.release()
+    if buf is None:
+        return
+
+    extracted = extractions.submit(
+        extract_artifact,
+        buf,
+        save_to,
+        artifact["created_at"],
+        member_extractions,
+        stop,
+    )
 
-        response = requests.get(artifact["archive_download_url"], headers=HEADERS)
-        if response.status_code != 200:
-            abort_if_fail(response, "Unable to download artifact %s" % artifact["name"])
+    def extraction_done(future):
+        # Stop the others right away if this one failed
+        if not future.cancelled() and future.exception() is not None:
+            stop.set()
+        pending.release()
 
-        # Create a temporary directory
-        tmp = tempfile.mkdtemp()
-        zipfile = ZipFile(BytesIO(response.content))
-        res = zipfile.extractall(tmp)
+    extracted.add_done_callback(extraction_done)
+    return extracted
 
-        save_to = os.path.join(output, "results")
-        if artifact["name"].startswith("cache"):
-            continue
+
+def download_artifact(session, artifact):
+    """
+    Download the archive for an artifact to a file (in memory until it gets
+    large, on Python 3.11+), and return it. Return None if the download failed.
+    """
+    response = get_with_backoff(session, artifact["archive_download_url"], stream=True)
+    if response.status_code != 200:
+        abort_if_fail(response, "Unable to download artifact %s" % artifact["name"])
+        return
+
+    # ZipFile needs seekable(), which SpooledTemporaryFile has on Python 3.11+
+    if hasattr(tempfile.SpooledTemporaryFile, "seekable"):
+        buf = tempfile.SpooledTemporaryFile(max_size=64 << 20)
+    else:
+        buf = tempfile.TemporaryFile()
+    for chunk in response.iter_content(1 << 20):
+        buf.write(chunk)
+    buf.seek(0)
+    return buf
+
+
+def extract_artifact(buf, save_to, created_at, member_extractions, stop):
+    """
+    Extract a downloaded artifact archive, saving new or newer result files
+    to save_to. created_at is when the artifact was created, so that if
+    several artifacts have a result file the newest one is kept. Members are
+    extracted with the member_extractions executor. Nothing more is saved
+    once we are told to stop (another artifact failed).
+    """
+    # Extract to a temporary directory, which is removed even if we fail
+    with tempfile.TemporaryDirectory(prefix="splice_") as tmp:
+        # Extract only the members that are new or changed
+        with buf:
+            if stop.is_set():
+                return
+            zipfile = ZipFile(buf)
+            members = get_changed_members(zipfile, save_to, created_at)
+            paths = extract_members(zipfile, members, tmp, member_extractions)
+
+        # The archive has the size and CRC32 of each file, so we don't need to
+        # stat or read them
+        extracted = dict(zip(paths, members))
 
         # Loop through files, add those that aren't present
-        for filename in recursive_find(tmp):
+        for entry in recursive_find(tmp):
+            filename = entry.path
             relpath = filename.replace(tmp, "").strip(os.sep)
             finalpath = os.path.join(save_to, relpath)
+            contender = extracted[filename]
+            if stop.is_set():
+                return
 
-            # If the file doesn't have size, don't add
-            size = get_size(filename)
-            if size == 0:
-                print("Result file %s has size 0, skipping." % relpath)
-                continue
+            # Another artifact might have the same result file. Keep the one
+            # from the newest artifact (results from earlier runs are older).
+            with get_path_lock(finalpath):
+                existing = get_stat(finalpath)
+                newer = created_at > _saved_from.get(finalpath, "")
+
+                # If it doesn't exist, add right away!
+                if not existing:
+                    print("Found new result file: %s" % relpath)
+                    save_artifact(filename, finalpath)
 
-            # If it doesn't exist, add right away!
-            if not os.path.exists(finalpath):
-                print("Found new result file: %s" % relpath)
-                save_artifact(filename, finalpath)
+                # Otherwise compare by size, and then by CRC32. The existing file's
+                # CRC32 is usually cached from checking which members to extract.
+                elif (
+                    contender.file_size != existing.st_size
+                    or cached_hash(finalpath, "crc32", existing)
+                    != "%08x" % contender.CRC
+                ):
+                    if not newer:
+                        continue
+                    print("Found a newer result for %s" % relpath)
+                    save_artifact(filename, finalpath)
 
-            # Otherwise compare by hash
-            else:
-                newhash = get_file_hash(filename)
-                oldhash = get_file_hash(finalpath)
+                if newer:
+                    _saved_from[finalpath] = created_at
 
-                # If they aren't equal, compare by date and add newer
-                if oldhash != newhash:
-                    existing_timestamp = get_creation_timestamp(finalpath)
-                    contender_timestamp = get_creation_timestamp(filename)
-                    if contender_timestamp > existing_timestamp:
-                        print("Found a newer result for %s" % relpath)
-                        save_artifact(filename, finalpath)
 
-        # Cleanup the temporary directory
-        shutil.rmtree(tmp)
+# Directories save_artifact has already made
+_created_dirs = set()
 
 
 def save_artifact(source, destination):
     """
-    Save an artifact.
+    Save an artifact, moving it into place (the source is a temporary file).
     """
     destdir = os.path.dirname(destination)
-    if not os.path.exists(destdir):
-        os.makedirs(destdir)
-    if os.path.exists(destination):
-        os.remove(destination)
-    shutil.copyfile(source, destination)
+    if destdir not in _created_dirs:
+        os.makedirs(destdir, exist_ok=True)
+        _created_dirs.add(destdir)
+    try:
+        os.replace(source, destination)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+        # On another filesystem, copy alongside and rename so it's still atomic
+        partial = destination + ".tmp"
+        shutil.copyfile(source, partial)
+        os.replace(partial, destination)
+        os.remove(source)
 
 
 def main():
     """main primarily parses environment variables to prepare for creation"""
 
     # Github repository to check
-    repository = os.environ.get("INPUT_REPOSITORY") or os.environ.get(
-        "GITHUB_REPOSITORY"
-    )
+    repository = os.environ.get("INPUT_REPOSITORY") or get_envar("GITHUB_REPOSITORY")
     output = os.environ.get("INPUT_OUTPUT", os.path.join(here, "artifacts"))
 
     # Number of days to go back (stick to max otherwise cannot run)
     days = int(os.environ.get("INPUT_DAYS", 10))
 
-    # Retrieve artifacts
-    artifacts = get_artifacts(repository, days)
+    # used to calculate if something is too old to parse
+    today = datetime.now()
+    cutoff = get_cutoff(today, days)
+
+    # One session (and connection pool) for all requests
+    session = get_session(get_envar("GITHUB_TOKEN"))
+
+    # Retrieve artifacts, reusing pages that haven't changed since last run
+    load_page_cache(output)
+    artifacts = get_artifacts(session, repository, cutoff)
+    save_page_cache(output)
+
+    # Reuse file hashes from previous runs
+    load_hash_cache(output)
 
     # Download artifacts to output directory
-    download_artifacts(artifacts, output, days)
+    download_artifacts(session, artifacts, output, cutoff if days else None)
+    save_hash_cache(output)
 
 
 if __name__ == "__main__":